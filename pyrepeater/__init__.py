@@ -7,8 +7,17 @@ from controller import Controller
 from repeater import Repeater
 from settings import ControllerSettings, RepeaterSettings
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 LOG_FORMAT = "%(asctime)s:%(levelname)s:%(name)s:%(message)s"
 logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+# the log format doesn't use thread or process info, so skip collecting it
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
 logger = logging.getLogger("pyrepeater")
 
 
@@ -43,4 +52,7 @@ async def main():
 
 
 if __name__ == "__main__":
+    # prefer uvloop's libuv based event loop when it is available
+    if uvloop is not None:
+        uvloop.install()
     asyncio.run(main())
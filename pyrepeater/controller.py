@@ -1,34 +1,86 @@
 """ repeater controller manages the state of the repeater, recordings, and announcements"""
+import asyncio
+import io
 import logging
-import subprocess
-from dataclasses import dataclass
-from datetime import datetime, timedelta
-from typing import List
+import os
+import threading
+import wave
+from collections import deque
+from dataclasses import dataclass, field
+from enum import IntEnum
+from time import monotonic
+from typing import Callable, Deque, Dict, Optional, Sequence, Set, Tuple
 
 from repeater import Repeater, RepeaterStatus
-from recorder import RecordingManager
+from recorder import RecordingManager, stop_process
 
 logger = logging.getLogger(__name__)
 
+CW_ID_WAV = "cw_id.wav"
+RPT_INFO_WAV = "repeater_info.wav"
+MAX_PENDING_MESSAGES = 8  # oldest messages are dropped beyond this
+
+# cached announcements are all converted to this format, so that any of them
+# can be joined into a single stream for play
+PCM_CHANNELS = 1
+PCM_RATE = 8000
+PCM_WIDTH = 2  # bytes per sample
+PCM_BYTES_PER_SEC = PCM_CHANNELS * PCM_RATE * PCM_WIDTH
+
+
+async def load_pcm(path: str) -> bytes:
+    """decode a sound file to raw pcm frames in the common playback format"""
+    proc = await asyncio.create_subprocess_exec(
+        "sox",
+        path,
+        "-t",
+        "raw",
+        "-c",
+        str(PCM_CHANNELS),
+        "-r",
+        str(PCM_RATE),
+        "-b",
+        str(PCM_WIDTH * 8),
+        "-e",
+        "signed-integer",
+        "-",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    pcm, _ = await proc.communicate()
+    if proc.returncode != 0:
+        raise OSError(f"sox exited with status {proc.returncode}")
+    return pcm
+
+
+class SleepState(IntEnum):
+    """the operational modes the sleep manager moves between"""
+
+    AWAKE = 0  # in regular use
+    ASLEEP = 1  # unused for 'sleep_after_mins'
+    WAKING = 2  # asleep, but busy; waiting 'wake_after_sec' before waking
+
 
 @dataclass
 class SleepStatus:
     """a class to represent sleep status of the repeater ie. it has gone unused for some time"""
 
-    sleep: bool = False  # is sleep?
-    start_dt: datetime = datetime.now()  # when did sleep start?
-    end_dt: datetime = None  # when did sleep end?
-    sleep_wait_start: datetime = None  # when did we start waiting for sleep?
-    wake_wait_start: datetime = None  # when did we start waiting for wake?
+    state: SleepState = SleepState.AWAKE  # current sleep mode
+    start_time: float = field(default_factory=monotonic)  # when did sleep start?
+    end_time: Optional[float] = None  # when (monotonic) did sleep end?
+    sleep_wait_start: Optional[float] = None  # when did we start waiting for sleep?
+    wake_wait_start: Optional[float] = None  # when did we start waiting to wake?
 
 
 @dataclass
 class ControllerStatus:
     """a class to represent the status of the controller and repeater announcments"""
 
-    last_id: datetime
-    last_announcement: datetime
-    pending_messages: List[str]
+    __slots__ = ("last_id", "last_announcement", "pending_messages")
+
+    last_id: float  # monotonic seconds
+    last_announcement: float  # monotonic seconds
+    pending_messages: Deque[str]
 
 
 class SleepManager:
@@ -38,58 +90,95 @@ class SleepManager:
         self.repeater: Repeater = repeater
         self.settings = settings
         self.sleep_status: SleepStatus = SleepStatus()
-
-    async def sleep_timer(self) -> None:
+        self._sleep_after_sec: int = settings.sleep_after_mins * 60
+        self._wake_after_sec: int = settings.wake_after_sec
+        self._handlers: Dict[SleepState, Callable[[float], None]] = {
+            SleepState.AWAKE: self._when_awake,
+            SleepState.ASLEEP: self._when_asleep,
+            SleepState.WAKING: self._when_waking,
+        }
+
+    def sleep_timer(self, now: float) -> None:
         """sleep timer, called periodically by the main loop"""
+        self._handlers[self.sleep_status.state](now)
+
+    def next_transition(self) -> float:
+        """the monotonic time at which the sleep state may next change by itself"""
+        state = self.sleep_status.state
+        if state == SleepState.AWAKE and not self.repeater.status.busy:
+            return self.repeater.check_last_rcvd() + self._sleep_after_sec
+        if state == SleepState.WAKING:
+            return self.sleep_status.wake_wait_start + self._wake_after_sec
+        # otherwise only a COS edge can change it
+        return float("inf")
+
+    def _when_awake(self, now: float) -> None:
+        """sleep after 'sleep_after_mins' minutes of inactivity"""
+        if self.repeater.status.busy:
+            return
+        if now - self.repeater.check_last_rcvd() < self._sleep_after_sec:
+            return
 
-        # sleep after 'sleep_after_mins' minutes of inactivity
-        if not self.sleep_status.sleep and (
-            timedelta.total_seconds(
-                datetime.now() - await self.repeater.check_last_rcvd()
-            )
-            >= self.settings.sleep_after_mins * 60
-        ):
-            logger.info(
-                "Entering sleep state.  Last used over %s mins ago.",
-                self.settings.sleep_after_mins,
-            )
-            self.sleep_status.sleep = True
-            self.sleep_status.start_dt = datetime.now()
+        logger.info(
+            "Entering sleep state.  Last used over %s mins ago.",
+            self.settings.sleep_after_mins,
+        )
+        self.sleep_status.state = SleepState.ASLEEP
+        self.sleep_status.start_time = now
+
+    def _when_asleep(self, now: float) -> None:
+        """start waiting to wake as soon as the repeater becomes busy"""
+        if self.repeater.status.busy:
+            self.sleep_status.state = SleepState.WAKING
+            self.sleep_status.wake_wait_start = now
+
+    def _when_waking(self, now: float) -> None:
+        """wake after 'wake_after_sec' seconds of activity"""
+        # a short key up doesn't disrupt sleep
+        if not self.repeater.status.busy:
+            self.sleep_status.state = SleepState.ASLEEP
+            return
+        if now - self.sleep_status.wake_wait_start < self._wake_after_sec:
+            return
 
-        # wake after 'wake_after_sec' seconds of activity
-        if self.sleep_status.sleep and (
-            timedelta.total_seconds(
-                datetime.now() - await self.repeater.check_last_rcvd()
-            )
-            <= self.settings.wake_after_sec
-        ):
-            logger.info(
-                "Leaving sleep state.  Active for %s seconds.",
-                self.settings.wake_after_sec,
-            )
-            self.sleep_status.sleep = False
-            self.sleep_status.end_dt = datetime.now()
+        logger.info(
+            "Leaving sleep state.  Active for %s seconds.",
+            self.settings.wake_after_sec,
+        )
+        self.sleep_status.state = SleepState.AWAKE
+        self.sleep_status.end_time = now
 
-    async def is_sleeping(self) -> bool:
+    def is_sleeping(self) -> bool:
         """is the repeater sleeping?"""
-        return self.sleep_status.sleep
+        return self.sleep_status.state != SleepState.AWAKE
 
 
-class Controller:
+class Controller:  # pylint: disable=too-many-instance-attributes
     """a class to represent a controller"""
 
     def __init__(self, repeater, settings) -> None:
         self.repeater: Repeater = repeater
         self.settings = settings
+        self._id_sec: int = settings.id_mins * 60
+        self._rpt_info_sec: int = settings.rpt_info_mins * 60
+        self._id_when_asleep: bool = settings.id_when_asleep
+        self._rpt_info_when_asleep: bool = settings.rpt_info_when_asleep
+        self._cw_id: str = os.path.join(settings.sounds_dir, CW_ID_WAV)
+        self._rpt_info: str = os.path.join(settings.sounds_dir, RPT_INFO_WAV)
         self.recording_mgr: RecordingManager = None
         self.sleep_mgr: SleepManager = None
-        self.sleep_status: SleepStatus = (SleepStatus(),)
-        self.repeater_status: RepeaterStatus = (RepeaterStatus(),)
+        self.cos_task: asyncio.Task = None
+        self._cos_event: asyncio.Event = asyncio.Event()
+        self.sleep_status: SleepStatus = SleepStatus()
+        self.repeater_status: RepeaterStatus = RepeaterStatus()
         self.status: ControllerStatus = ControllerStatus(
-            last_id=datetime(1970, 1, 1),
-            last_announcement=datetime(1970, 1, 1),
-            pending_messages=[],
+            last_id=float("-inf"),
+            last_announcement=float("-inf"),
+            pending_messages=deque(maxlen=MAX_PENDING_MESSAGES),
         )
+        self._wav_cache: Dict[str, bytes] = {}
+        self._bundle_cache: Dict[Tuple[str, ...], bytes] = {}
+        self._available_sounds: Set[str] = set()
 
     async def start_controller(self):
         """start the controller"""
@@ -97,24 +186,116 @@ class Controller:
         # create managers
         self.sleep_mgr = SleepManager(self.repeater, self.settings)
         self.recording_mgr = RecordingManager(self.repeater, self.settings)
-
-        # main controller loop
+        await self.recording_mgr.start_capture()
+
+        # check the announcement wav files and decode them once, up front.
+        # a missing ID is a compliance problem, so make it loud at startup
+        for path in (self._rpt_info, self._cw_id):
+            if not os.path.isfile(path):
+                logger.warning("Sound file %s is missing.  It will not play.", path)
+                continue
+            self._available_sounds.add(path)
+            try:
+                self._wav_cache[path] = await load_pcm(path)
+            except OSError as err:
+                logger.warning("Unable to preload wav file %s: %s", path, err)
+
+        # build the full announcement (repeater info + ID) ahead of time too
+        self.cached_wav((self._rpt_info, self._cw_id))
+
+        # watch the COS line in the background
+        self.cos_task = asyncio.create_task(self.cos_watcher())
+        main_task = asyncio.create_task(self.main_loop())
+
+        try:
+            # the main loop only hears about COS edges from the watcher, so if
+            # either of them dies, stop and surface its error
+            done, _ = await asyncio.wait(
+                {main_task, self.cos_task}, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                task.result()
+        finally:
+            self.cos_task.cancel()
+            main_task.cancel()
+            await asyncio.gather(main_task, return_exceptions=True)
+            await self.recording_mgr.stop_capture()
+
+    async def main_loop(self) -> None:
+        """main controller loop"""
+        # the managers and their callables are fixed once started, so bind them
+        # up front rather than looking them up on every pass
+        timer_tick = self.settings.timer_tick
+        cos_event = self._cos_event
+        repeater_status = self.repeater.status
+        pending = self.status.pending_messages
+        check_status = self.repeater.check_status
+        update_recording = self.recording_mgr.update_status
+        next_timed_event = self.next_timed_event
+        check_for_timed_events = self.check_for_timed_events
         while True:
-            # check the repeater status
-            await self.repeater.check_status()
+            # wait for a COS edge, or for the next timed event to fall due
+            timeout = min(timer_tick, max(0.0, next_timed_event() - monotonic()))
+            try:
+                await asyncio.wait_for(cos_event.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            cos_event.clear()
+
+            # check the repeater status, sampling the COS line once per pass
+            await check_status()
+            busy = repeater_status.busy
 
             # update the recording status
-            await self.recording_mgr.update_status()
+            update_recording(busy)
 
             # check for timed events (ex. annoucements and CW ID)
-            await self.check_for_timed_events()
+            check_for_timed_events(monotonic())
 
             # otherwise, if repeater is not busy, play pending messages
-            if not await self.repeater.is_busy() and self.status.pending_messages:
-                await self.play_pending_messages(self.status.pending_messages)
-                await self.repeater.serial_disable_tx(self.repeater)
-
-    async def play_pending_messages(self, wav_files: List[str]) -> None:
+            if not busy and pending:
+                await self.play_pending_messages(pending)
+
+    async def cos_watcher(self) -> None:
+        """watch the repeater's COS line and signal the main loop on every edge"""
+        loop = asyncio.get_running_loop()
+        fallback = asyncio.Event()
+
+        def wait_for_edges() -> None:
+            # the ioctl blocks until the line changes and can't be cancelled,
+            # so it gets a daemon thread of its own rather than the executor
+            try:
+                while True:
+                    self.repeater.wait_for_cos_change()
+                    loop.call_soon_threadsafe(self._cos_event.set)
+            except OSError as err:
+                logger.warning(
+                    "Serial port can't report COS changes (%s).  Polling instead.",
+                    err,
+                )
+                loop.call_soon_threadsafe(fallback.set)
+
+        threading.Thread(target=wait_for_edges, name="cos", daemon=True).start()
+        await fallback.wait()
+        await self.poll_cos()
+
+    async def poll_cos(self) -> None:
+        """poll the repeater's COS line and signal the main loop on every edge"""
+        is_busy = self.repeater.is_busy_async
+        idle_interval = self.settings.poll_interval
+        busy_interval = self.settings.busy_poll_interval
+        busy = await is_busy()
+        while True:
+            # sample faster while busy so the drop is caught quickly, and keep
+            # the cadence steady by not counting the read time twice
+            started = monotonic()
+            if await is_busy() != busy:
+                busy = not busy
+                self._cos_event.set()
+            interval = busy_interval if busy else idle_interval
+            await asyncio.sleep(max(0.0, interval - (monotonic() - started)))
+
+    async def play_pending_messages(self, wav_files: Sequence[str]) -> None:
         """play the list of wav files in pending_messages"""
         if not self.status.pending_messages:
             logger.debug("No pending messages to play.")
@@ -122,68 +303,161 @@ class Controller:
 
         logger.debug("Playing pending messages...")
 
-        # start tx
-        await self.repeater.serial_enable_tx(self.repeater)
-
-        for message in wav_files:
-            # play the wav file
-            logger.info("Playing wav file: %s", message)
-            subprocess.run(
-                ["play", "-q", message],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-                check=False,
-            )
+        # key up only for as long as it takes to play the queue
+        async with self.repeater.tx():
+            try:
+                played = await self.play_wav_files(wav_files)
+            except OSError as err:
+                # don't keep re-keying for messages that can't be played
+                logger.error("Unable to play pending messages with error: %s", err)
+                self.status.pending_messages.clear()
+                return
+
+        if played is None:
+            logger.debug("Done playing pending messages.  Clearing queue...")
+            self.status.pending_messages.clear()
+            return
 
-        # stop tx
-        await self.repeater.serial_disable_tx(self.repeater)
+        # drop only the messages that were played in full, keeping the rest
+        # queued for the next time the repeater is free
+        pending = self.status.pending_messages
+        while pending and pending[0] in self._wav_cache:
+            duration = len(self._wav_cache[pending[0]]) / PCM_BYTES_PER_SEC
+            if duration > played:
+                break
+            played -= duration
+            pending.popleft()
+        logger.debug(
+            "Playback stopped early.  %s messages still pending.", len(pending)
+        )
 
-        logger.debug("Done playing pending messages.  Clearing queue...")
-        self.status.pending_messages.clear()
+    async def play_wav_files(self, wav_files: Sequence[str]) -> Optional[float]:
+        """
+        play wav files, stopping early if a user keys up. returns None if they
+        all played, otherwise the seconds of audio played before stopping.
+        raises OSError if play fails
+        """
+        # play all of the wav files back to back in a single sox process,
+        # feeding it from the cache when every file has been preloaded
+        cached = self.cached_wav(wav_files)
+        if cached is None:
+            # sox gives up on the whole list if any input can't be opened, so
+            # only hand it the files that are there
+            wav_files = [path for path in wav_files if os.path.isfile(path)]
+            if not wav_files:
+                logger.warning("None of the pending wav files exist.")
+                return None
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Playing wav files: %s", ", ".join(wav_files))
+        if cached is not None:
+            proc = await asyncio.create_subprocess_exec(
+                "play",
+                "-q",
+                "-t",
+                "wav",
+                "-",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            playback = asyncio.ensure_future(proc.communicate(cached))
+        else:
+            proc = await asyncio.create_subprocess_exec(
+                "play",
+                "-q",
+                *wav_files,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            playback = asyncio.ensure_future(proc.wait())
+        start = monotonic()
 
-    async def repeaterinfo_timer(self) -> None:
+        # keep the loop live during playback, and stop playing if a user keys up
+        cos_edge = asyncio.ensure_future(self._cos_event.wait())
+        done, _ = await asyncio.wait(
+            {playback, cos_edge}, return_when=asyncio.FIRST_COMPLETED
+        )
+        cos_edge.cancel()
+        if playback not in done:
+            # note how far playback got before spending time stopping it
+            played = monotonic() - start
+            logger.info("Repeater keyed up.  Stopping playback.")
+            await stop_process(proc)
+            await playback
+            return played
+        if proc.returncode != 0:
+            raise OSError(f"play exited with status {proc.returncode}")
+        return None
+
+    def cached_wav(self, wav_files: Sequence[str]) -> Optional[bytes]:
         """
-        checks if the repeater info announcement should be played based on the
-        last time it was played and the 'rpt_info_mins' setting
+        join the cached audio for wav_files into a single in-memory wav file.
+        returns None if any file is not cached
         """
-        if (
-            timedelta.total_seconds(datetime.now() - self.status.last_announcement)
-            <= self.settings.rpt_info_mins * 60
-        ):
+        key = tuple(wav_files)
+        if key in self._bundle_cache:
+            return self._bundle_cache[key]
+        if not all(path in self._wav_cache for path in wav_files):
+            return None
+
+        buf = io.BytesIO()
+        wav = wave.open(buf, "wb")
+        wav.setnchannels(PCM_CHANNELS)
+        wav.setsampwidth(PCM_WIDTH)
+        wav.setframerate(PCM_RATE)
+        wav.writeframes(b"".join(self._wav_cache[path] for path in wav_files))
+        wav.close()
+        self._bundle_cache[key] = buf.getvalue()
+        return self._bundle_cache[key]
+
+    def queue_message(self, wav_file: str) -> None:
+        """add a wav file to pending_messages unless it is missing or already queued"""
+        if wav_file not in self._available_sounds:
             return
+        if wav_file not in self.status.pending_messages:
+            self.status.pending_messages.append(wav_file)
+
+    def _queue_id(self, now: float) -> None:
+        """queue the CW ID and restart the ID interval from 'now'"""
+        self.queue_message(self._cw_id)
+        self.status.last_id = now
+
+    def next_timed_event(self) -> float:
+        """the monotonic time at which the next timed event falls due"""
+        due = [self.sleep_mgr.next_transition()]
+        sleeping = self.sleep_mgr.is_sleeping()
+        if not sleeping or self._rpt_info_when_asleep:
+            due.append(self.status.last_announcement + self._rpt_info_sec)
+        if not sleeping or self._id_when_asleep:
+            due.append(self.status.last_id + self._id_sec)
+        return min(due)
+
+    def check_for_timed_events(self, now: float) -> None:
+        """
+        check for timed events (sleep, repeater info announcement and CW ID),
+        all against the same 'now'
+        """
+        self.sleep_mgr.sleep_timer(now)
+        sleeping = self.sleep_mgr.is_sleeping()
 
-        if not await self.sleep_mgr.is_sleeping() or self.settings.rpt_info_when_asleep:
+        # repeater info every 'rpt_info_mins', which includes an ID
+        if now - self.status.last_announcement >= self._rpt_info_sec and (
+            not sleeping or self._rpt_info_when_asleep
+        ):
             logger.info(
                 "Last announcement was over %s mins ago.  Playing announcement.",
                 self.settings.rpt_info_mins,
             )
-            self.status.pending_messages.append("sounds/repeater_info.wav")
-            self.status.last_announcement = datetime.now()
-            self.status.pending_messages.append("sounds/cw_id.wav")
-            self.status.last_id = datetime.now()
+            self.queue_message(self._rpt_info)
+            self.status.last_announcement = now
+            self._queue_id(now)
 
-    async def cwid_timer(self) -> None:
-        """
-        checks if the CW ID should be played based on the last time it was
-        played and the 'id_mins' setting
-        """
-
-        if (
-            timedelta.total_seconds(datetime.now() - self.status.last_id)
-            <= self.settings.id_mins * 60
+        # CW ID every 'id_mins'
+        if now - self.status.last_id >= self._id_sec and (
+            not sleeping or self._id_when_asleep
         ):
-            return
-
-        if not await self.sleep_mgr.is_sleeping() or self.settings.id_when_asleep:
             logger.info(
                 "Last CW ID was over %s minutes ago.  Playing ID.",
                 self.settings.id_mins,
             )
-            self.status.pending_messages.append("sounds/cw_id.wav")
-            self.status.last_id = datetime.now()
-
-    async def check_for_timed_events(self) -> None:
-        """check for timed events ex. CW ID"""
-        await self.sleep_mgr.sleep_timer()
-        await self.repeaterinfo_timer()
-        await self.cwid_timer()
+            self._queue_id(now)
@@ -1,21 +1,48 @@
 """ manages recording """
 
+import asyncio
 import logging
-import subprocess
+import os
+import wave
+from asyncio.subprocess import Process
 from dataclasses import dataclass
-from datetime import datetime, timedelta
+from time import localtime, monotonic
+from typing import BinaryIO
 
 from repeater import Repeater
 
 logger = logging.getLogger(__name__)
 
+CHANNELS = 1
+SAMPLE_RATE = 8000
+SAMPLE_WIDTH = 2  # bytes per sample
+CHUNK_SIZE = 4096  # bytes read from the capture pipe at a time
+STOP_TIMEOUT = 1.0  # seconds to wait for a terminated process before killing it
+RESTART_DELAY = 5.0  # seconds to wait before restarting a capture process that died
+
+
+async def stop_process(proc: Process) -> None:
+    """terminate a subprocess and reap it, killing it if it won't exit"""
+    if proc.returncode is not None:
+        return
+    proc.terminate()
+    try:
+        await asyncio.wait_for(proc.wait(), timeout=STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Process %s did not exit.  Killing it.", proc.pid)
+        proc.kill()
+        await proc.wait()
+
 
 @dataclass
 class Recording:
     """a class to represent a recorder"""
 
-    proc: subprocess.Popen
-    start_time: datetime
+    __slots__ = ("wav", "file", "start_time", "file_name")
+
+    wav: wave.Wave_write
+    file: BinaryIO  # wave doesn't close files it didn't open itself
+    start_time: float  # monotonic seconds
     file_name: str
 
 
@@ -26,59 +53,158 @@ class RecordingManager:
         self.recording: Recording = None
         self.repeater = repeater
         self.settings = settings
+        self.capture: Process = None
+        self.capture_task: asyncio.Task = None
+        self.stopping: bool = False  # is the capture being shut down?
+
+    async def start_capture(self) -> None:
+        """
+        start a single long-lived rec process streaming raw pcm to us, so
+        starting a recording is just opening a file rather than a fork+exec
+        """
+        self.capture = await asyncio.create_subprocess_exec(
+            "rec",
+            "-q",
+            "-c",
+            str(CHANNELS),
+            "-r",
+            str(SAMPLE_RATE),
+            "-b",
+            str(SAMPLE_WIDTH * 8),
+            "-e",
+            "signed-integer",
+            "-t",
+            "raw",
+            "-",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        self.capture_task = asyncio.create_task(self.read_capture())
+        self.capture_task.add_done_callback(self.capture_done)
+
+    async def stop_capture(self) -> None:
+        """stop the capture process, closing any open recording"""
+        self.stop_recording()
+        self.stopping = True
+        # stop the process before the reader, so the pipe keeps draining and
+        # the process can be reaped as soon as it exits
+        if self.capture:
+            await stop_process(self.capture)
+        if self.capture_task:
+            self.capture_task.cancel()
+
+    async def read_capture(self) -> None:
+        """drain the capture pipe, writing frames out while a recording is open"""
+        while True:
+            data = await self.capture.stdout.read(CHUNK_SIZE)
+            if not data:
+                break
+            if self.recording:
+                try:
+                    self.recording.wav.writeframesraw(data)
+                except OSError as err:
+                    # ex. disk full, so give up on this recording but keep
+                    # draining the pipe so rec doesn't stall
+                    logger.error("Unable to write recording with error: %s", err)
+                    self.stop_recording(discard=True)
+        if self.stopping:
+            return
 
-    async def update_status(self) -> None:
+        # rec exited (ex. device unplugged), so close out any recording it was
+        # feeding and bring the capture back up
+        returncode = await self.capture.wait()
+        logger.error(
+            "Audio capture exited with status %s.  Restarting in %s secs.",
+            returncode,
+            RESTART_DELAY,
+        )
+        self.stop_recording()
+        await asyncio.sleep(RESTART_DELAY)
+        try:
+            await self.start_capture()
+        except OSError as err:
+            logger.error("Unable to restart audio capture with error: %s", err)
+
+    def capture_done(self, task: asyncio.Task) -> None:
+        """log the capture reader failing, and close the recording it was feeding"""
+        if task.cancelled() or task.exception() is None:
+            return
+        logger.error("Audio capture failed.", exc_info=task.exception())
+        self.stop_recording()
+
+    def update_status(self, busy: bool) -> None:
         """if repeater is busy, start recording, if it becomes free, stop recording"""
-        if await self.repeater.is_busy() and not self.recording:
-            await self.start_recording()
-        elif not await self.repeater.is_busy() and self.recording:
-            await self.stop_recording()
+        if busy and not self.recording:
+            self.start_recording()
+        elif not busy and self.recording:
+            self.stop_recording()
 
-    async def is_recording(self) -> bool:
+    def is_recording(self) -> bool:
         """is the recorder recording?"""
         return self.recording is not None
 
-    async def start_recording(self) -> None:
+    def start_recording(self) -> None:
         """start a recording"""
-        current_time = datetime.now()
-        current_str = current_time.strftime("%Y-%m-%d_%H-%M-%S")
-        recording_name = f"recordings/{current_str}.wav"
+        now = localtime()
+        recording_name = (
+            f"recordings/{now.tm_year:04d}-{now.tm_mon:02d}-{now.tm_mday:02d}_"
+            f"{now.tm_hour:02d}-{now.tm_min:02d}-{now.tm_sec:02d}.wav"
+        )
 
         # start recording
         logger.debug("Recording to file: %s", recording_name)
-        process = subprocess.Popen(  # pylint: disable=consider-using-with
-            ["rec", "-q", "-c", "1", "-r", "8000", recording_name]
-        )
+        try:
+            file = open(recording_name, "wb")  # pylint: disable=consider-using-with
+        except OSError as err:
+            # losing a recording shouldn't take the rest of the controller down
+            logger.error("Unable to start recording with error: %s", err)
+            return
+        wav = wave.open(file, "wb")
+        wav.setnchannels(CHANNELS)
+        wav.setsampwidth(SAMPLE_WIDTH)
+        wav.setframerate(SAMPLE_RATE)
         self.recording = Recording(
-            proc=process, start_time=current_time, file_name=recording_name
+            wav=wav, file=file, start_time=monotonic(), file_name=recording_name
         )
 
-    async def stop_recording(self) -> None:
-        """stop the recording"""
+    def stop_recording(self, discard: bool = False) -> None:
+        """stop the recording, deleting it if discard is set"""
         if not self.recording:
             return
 
         # check how long the recording was
-        recording_time = timedelta.total_seconds(
-            datetime.now() - self.recording.start_time
-        )
+        recording_time = monotonic() - self.recording.start_time
 
         # end recording
-        self.recording.proc.terminate()
+        try:
+            try:
+                self.recording.wav.close()
+            finally:
+                self.recording.file.close()
+        except OSError as err:
+            logger.error("Unable to finish recording with error: %s", err)
+            discard = True
 
         logger.debug("Stopped recording. (%s s)", recording_time)
 
         # if recording was less than min_rec_secs, delete it
-        if recording_time < self.settings.min_rec_secs:
+        if discard:
+            logger.debug("Discarding recording.")
+        elif recording_time < self.settings.min_rec_secs:
             logger.debug(
                 "Recording was less than %s seconds.  Deleting recording.",
                 self.settings.min_rec_secs,
             )
-            subprocess.run(["rm", "-f", self.recording.file_name], check=False)
-
+            discard = True
         else:
             logger.info(
                 "Recorded %s secs to %s", recording_time, self.recording.file_name
             )
 
+        if discard:
+            try:
+                os.unlink(self.recording.file_name)
+            except FileNotFoundError:
+                pass
+
         self.recording = None
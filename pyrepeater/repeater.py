@@ -4,14 +4,21 @@ via a serial port
 """
 
 import asyncio
-from dataclasses import dataclass
-from datetime import datetime
+import fcntl
+import termios
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 import logging
+import struct
+from time import monotonic
 
 import serial
 
 logger = logging.getLogger(__name__)
 
+# PTT is keyed by raising both DTR and RTS
+PTT_LINES = struct.pack("I", termios.TIOCM_DTR | termios.TIOCM_RTS)
+
 
 @dataclass
 class RepeaterStatus:
@@ -21,7 +28,8 @@ class RepeaterStatus:
     """
 
     busy: bool = False
-    last_rcvd_dt: datetime = datetime.now()
+    transmitting: bool = False  # is PTT (DTR/RTS) asserted?
+    last_rcvd: float = field(default_factory=monotonic)  # monotonic seconds
 
 
 class Repeater:
@@ -48,46 +56,80 @@ class Repeater:
         """
         check the status of the repeater
         """
-        if not self.status.busy and await self.is_busy():
+        busy = await self.is_busy_async()
+        if not self.status.busy and busy:
             self.status.busy = True
-            self.status.last_rcvd_dt = datetime.now()
-            logger.debug("Repeater busy at %s", self.status.last_rcvd_dt)
-        elif self.status.busy and not await self.is_busy():
+            self.status.last_rcvd = monotonic()
+            logger.debug("Repeater busy.")
+        elif self.status.busy and not busy:
+            # stamp the falling edge too, so idle time counts from the end of
+            # the transmission without touching the clock while it is busy
             self.status.busy = False
-            logger.debug("Repeater inactive at %s", datetime.now())
+            self.status.last_rcvd = monotonic()
+            logger.debug("Repeater inactive.")
 
-    async def check_last_rcvd(self) -> datetime:
-        """reutrn the last time the repeater received a transmission"""
-        return self.status.last_rcvd_dt
+    def check_last_rcvd(self) -> float:
+        """return the last time (monotonic) the repeater received a transmission"""
+        return self.status.last_rcvd
 
-    async def is_busy(self) -> bool:
+    def is_busy(self) -> bool:
         """
         check if the repeater is busy
         """
         return self.serial.dsr
 
-    async def serial_enable_tx(self, repeater) -> None:
+    async def is_busy_async(self) -> bool:
         """
-        enable the serial port for transmit
+        check if the repeater is busy, reading the serial line in an executor
+        thread so a slow read cannot stall the event loop
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self._read_dsr)
+
+    def wait_for_cos_change(self) -> None:
+        """
+        block until the serial DSR (COS) line changes. raises OSError if the
+        serial driver can't report modem line changes
+        """
+        fcntl.ioctl(self.serial.fileno(), termios.TIOCMIWAIT, termios.TIOCM_DSR)
+
+    def _read_dsr(self) -> bool:
+        """blocking read of the serial DSR (COS) line"""
+        return self.serial.dsr
+
+    def _set_ptt(self, keyed: bool) -> None:
+        """raise or drop DTR and RTS together in a single ioctl"""
+        request = termios.TIOCMBIS if keyed else termios.TIOCMBIC
+        fcntl.ioctl(self.serial.fileno(), request, PTT_LINES)
+
+    @asynccontextmanager
+    async def tx(self):
+        """
+        key the transmitter for the duration of the block
         """
         try:
-            ser = repeater.serial
-            ser.setDTR(True)
-            ser.setRTS(True)
-            await asyncio.sleep(self.settings.pre_tx_delay)
-        except Exception as err:
-            logger.error("Unable to set serial port for transmit with error: %s", err)
-        return
+            # enable inside the try, so being cancelled during the pre tx delay
+            # still unkeys
+            await self.serial_enable_tx()
+            yield
+        finally:
+            await self.serial_disable_tx()
+
+    async def serial_enable_tx(self) -> None:
+        """
+        enable the serial port for transmit
+        """
+        if self.status.transmitting:
+            return
+        self._set_ptt(True)
+        self.status.transmitting = True
+        await asyncio.sleep(self.settings.pre_tx_delay)
 
-    async def serial_disable_tx(self, repeater) -> None:
+    async def serial_disable_tx(self) -> None:
         """
         disable the serial port for transmit
         """
-        try:
-            ser = repeater.serial
-            ser.setDTR(False)
-            ser.setRTS(False)
-            await asyncio.sleep(self.settings.post_tx_delay)
-        except Exception as err:
-            logger.error("Unable to set serial port end transmit with error: %s", err)
-        return
+        if not self.status.transmitting:
+            return
+        self._set_ptt(False)
+        self.status.transmitting = False
+        await asyncio.sleep(self.settings.post_tx_delay)
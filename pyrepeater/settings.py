@@ -27,6 +27,10 @@ class ControllerSettings(BaseSettings):
     sleep_after_mins: int = 10  # minutes of inactivity before sleep
     wake_after_sec: int = 2  # seconds of activity before leaving sleep
     min_rec_secs: int = 2  # minimum seconds to record
+    sounds_dir: str = "sounds"  # directory holding the announcement wav files
+    poll_interval: float = 0.05  # seconds between COS line samples while idle
+    busy_poll_interval: float = 0.01  # seconds between COS line samples while busy
+    timer_tick: float = 60.0  # max seconds between timed event checks
 
     class Settings(BaseSettings):
         """settings for settings"""